@@ -1,67 +1,369 @@
 #!/usr/bin/python3
 
+import io
 import os
+import re
+import sys
+import errno
 import shutil
 import stat
 import argparse
-import filecmp
+import atexit
 import pwd
 import grp
 import difflib
+import subprocess
+import mmap
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime
+from functools import lru_cache
 import curses
 
 LOGFILE = f"tomcat_conf_diff_log_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-
-def update_metadata(src, dst, verbose=False):
-    """Apply permissions and ownership from src to dst."""
-    stat_info = os.stat(src)
-    try:
-        os.chown(dst, stat_info.st_uid, stat_info.st_gid)
-    except PermissionError:
-        print(f"Warning: Cannot change owner/group for {dst} (requires root).")
-    os.chmod(dst, stat_info.st_mode)
-    if verbose:
-        owner = pwd.getpwuid(stat_info.st_uid).pw_name
-        group = grp.getgrgid(stat_info.st_gid).gr_name
-        mode = oct(stat_info.st_mode & 0o777)
+# Opened on the first logged diff and shared by the rest of the run.
+_log_fh = None
+
+_SEP = os.sep
+# Matches relative paths inside any "conf" directory, e.g. conf/server.xml or webapps/app/conf/x.xml.
+_CONF_RE = re.compile(r'(?:^|' + re.escape(_SEP) + r')conf' + re.escape(_SEP))
+
+CHUNK_SIZE = 1 << 20
+# Content compares are read-bound and release the GIL, so run many at once.
+COMPARE_WORKERS = min(32, (os.cpu_count() or 1) * 4)
+# Per-thread pair of CHUNK_SIZE compare buffers, allocated on first use.
+_compare_buffers = threading.local()
+
+# Conf files at least this large on both sides are diffed with the external
+# `diff -u`, which is much faster than difflib on big inputs.
+EXTERNAL_DIFF_MIN_SIZE = 128 * 1024
+DIFF_CMD = shutil.which('diff')
+
+# Destination directories already created or seen to exist during this run.
+_known_dirs = set()
+
+KERNEL_COPY_CHUNK = 1 << 30
+# errno values meaning "this in-kernel copy is not available here", not a real I/O error.
+_NO_KERNEL_COPY = {errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                   errno.ENOTSUP, errno.ENOTSOCK}
+
+@lru_cache(maxsize=None)
+def _uidname(uid):
+    return pwd.getpwuid(uid).pw_name
+
+@lru_cache(maxsize=None)
+def _gidname(gid):
+    return grp.getgrgid(gid).gr_name
+
+def update_metadata(dst, src_st, verbose=False):
+    """Apply permissions and ownership from the source stat result src_st to dst."""
+    dst_st = os.stat(dst)
+    # Only touch dst when it differs; each call also bumps its ctime.
+    applied = False
+    chowned = False
+    if (dst_st.st_uid, dst_st.st_gid) != (src_st.st_uid, src_st.st_gid):
+        try:
+            os.chown(dst, src_st.st_uid, src_st.st_gid)
+            applied = chowned = True
+        except PermissionError:
+            print(f"Warning: Cannot change owner/group for {dst} (requires root).")
+    # chown clears setuid/setgid, so the mode read above is stale after one.
+    if chowned or stat.S_IMODE(dst_st.st_mode) != stat.S_IMODE(src_st.st_mode):
+        os.chmod(dst, stat.S_IMODE(src_st.st_mode))
+        applied = True
+    if verbose and applied:
+        owner = _uidname(src_st.st_uid)
+        group = _gidname(src_st.st_gid)
+        mode = oct(src_st.st_mode & 0o777)
         print(f"Applied metadata to {dst} → owner={owner}, group={group}, mode={mode}")
 
-def copy_with_metadata(src, dst, is_dir=False, verbose=False):
+def _open_sequential(path):
+    """Open path read-only, hinting the kernel that it will be read once, front to back."""
+    fd = os.open(path, os.O_RDONLY)
+    if hasattr(os, 'posix_fadvise'):
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        except OSError:
+            pass
+    return fd
+
+def _copy_file_range(in_fd, out_fd):
+    """Copy with copy_file_range(2); returns False if nothing was copied."""
+    copied = False
+    while os.copy_file_range(in_fd, out_fd, KERNEL_COPY_CHUNK):
+        copied = True
+    return copied
+
+def _sendfile(in_fd, out_fd):
+    """Copy with sendfile(2); returns False if nothing was copied."""
+    copied = False
+    while os.sendfile(out_fd, in_fd, None, KERNEL_COPY_CHUNK):
+        copied = True
+    return copied
+
+def _kernel_copiers():
+    if hasattr(os, 'copy_file_range'):
+        yield _copy_file_range
+    if hasattr(os, 'sendfile'):
+        yield _sendfile
+
+def _fastcopy(src, dst):
+    """Copy src to dst like shutil.copy2, letting the kernel move the data when it can.
+
+    Falls back from copy_file_range to sendfile to a CHUNK_SIZE read/write loop.
+    Like shutil.copyfile, refuses special files (opening a FIFO would block)
+    and copying a file onto itself.
+    """
+    src_st = os.stat(src)
+    if not stat.S_ISREG(src_st.st_mode):
+        raise shutil.SpecialFileError(f"`{src}` is not a regular file")
+    try:
+        dst_st = os.stat(dst)
+    except FileNotFoundError:
+        pass
+    else:
+        if os.path.samestat(src_st, dst_st):
+            raise shutil.SameFileError(f"{src!r} and {dst!r} are the same file")
+        if stat.S_ISFIFO(dst_st.st_mode):
+            raise shutil.SpecialFileError(f"`{dst}` is a named pipe")
+    in_fd = _open_sequential(src)
+    try:
+        out_fd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+        try:
+            for copier in _kernel_copiers():
+                try:
+                    if copier(in_fd, out_fd):
+                        break
+                except OSError as e:
+                    if e.errno not in _NO_KERNEL_COPY:
+                        raise
+            else:
+                # Both fds keep their offsets, so this resumes wherever a kernel copier stopped.
+                buf = bytearray(CHUNK_SIZE)
+                view = memoryview(buf)
+                while True:
+                    n = os.readv(in_fd, [buf])
+                    if not n:
+                        break
+                    written = 0
+                    while written < n:
+                        written += os.write(out_fd, view[written:n])
+        finally:
+            os.close(out_fd)
+    finally:
+        os.close(in_fd)
+    shutil.copystat(src, dst)
+    return dst
+
+def _ensure_dir(path):
+    """os.makedirs(path, exist_ok=True), skipped for directories already known to exist."""
+    if path in _known_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    while path and path not in _known_dirs:
+        _known_dirs.add(path)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+def copy_with_metadata(src, dst, src_st, is_dir=False, verbose=False):
     """Copy file or directory and apply source metadata."""
     if is_dir:
         #shutil.copytree(src, dst)
-        shutil.copytree(src, dst, dirs_exist_ok=True)
+        shutil.copytree(src, dst, dirs_exist_ok=True, copy_function=_fastcopy)
     else:
-        shutil.copy2(src, dst)
-    update_metadata(src, dst, verbose)
+        _fastcopy(src, dst)
+    update_metadata(dst, src_st, verbose)
+
+def _read_chunk(fd, buf):
+    """Fill buf from fd, stopping short only at EOF. Returns the byte count."""
+    view = memoryview(buf)
+    total = 0
+    while total < len(buf):
+        n = os.readv(fd, [view[total:]])
+        if not n:
+            break
+        total += n
+    return total
+
+def _fast_equal(old_path, new_path):
+    """Byte-compare two files of equal size in CHUNK_SIZE blocks."""
+    try:
+        buf_old, buf_new = _compare_buffers.pair
+    except AttributeError:
+        buf_old, buf_new = _compare_buffers.pair = bytearray(CHUNK_SIZE), bytearray(CHUNK_SIZE)
+    old_fd = _open_sequential(old_path)
+    try:
+        new_fd = _open_sequential(new_path)
+        try:
+            while True:
+                n = _read_chunk(old_fd, buf_old)
+                if _read_chunk(new_fd, buf_new) != n:
+                    return False
+                if n < CHUNK_SIZE:
+                    # Bytes past n are left over from the previous block.
+                    return buf_old[:n] == buf_new[:n]
+                if buf_old != buf_new:
+                    return False
+        finally:
+            os.close(new_fd)
+    finally:
+        os.close(old_fd)
+
+def files_equal(old_path, new_path, shallow=True, old_st=None, new_st=None):
+    """Return True if both files have identical contents.
+
+    With shallow, files of the same type, size and mtime (to the second) are
+    taken as equal without reading them, as filecmp.cmp does. old_st and
+    new_st may carry already fetched os.stat() results.
+    """
+    if old_st is None:
+        old_st = os.stat(old_path)
+    if new_st is None:
+        new_st = os.stat(new_path)
+    if stat.S_IFMT(old_st.st_mode) != stat.S_IFMT(new_st.st_mode):
+        return False
+    if old_st.st_size != new_st.st_size:
+        return False
+    if shallow and int(old_st.st_mtime) == int(new_st.st_mtime):
+        return True
+    return _fast_equal(old_path, new_path)
+
+def _compare_conf(item, shallow):
+    """Compare-pool worker; returns (files equal, size of the new file)."""
+    new_st = os.stat(item.new_path)
+    equal = files_equal(item.old_path, item.new_path, shallow, item.src_st, new_st)
+    return equal, new_st.st_size
 
 def read_file_lines(path):
     try:
-        with open(path, 'r') as f:
-            return f.readlines()
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size > CHUNK_SIZE:
+                with mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ) as mm:
+                    data = mm[:]
+            else:
+                data = f.read()
+        # Split like text-mode readlines(): universal newlines, and no
+        # breaks at \f, \v or Unicode line separators. Non-UTF-8 bytes
+        # become \xNN escapes, so e.g. Latin-1 .properties still diff.
+        return io.StringIO(data.decode('utf-8', 'backslashreplace'), newline=None).readlines()
     except Exception:
         return []
 
-def log_diff(path, diff_lines):
-    with open(LOGFILE, 'a') as log:
-        log.write(f"\n--- {path} (old)\n+++ {path} (new)\n")
+def log_diff(path, diff_lines, verbose=False):
+    """Stream diff_lines into LOGFILE, echoing them to stdout when verbose.
+
+    Nothing is written for an empty diff.
+    """
+    diff_lines = iter(diff_lines)
+    first = next(diff_lines, None)
+    if first is None:
+        return
+    global _log_fh
+    if _log_fh is None:
+        _log_fh = open(LOGFILE, 'a', buffering=1 << 16)
+        atexit.register(_log_fh.close)
+    log = _log_fh
+    if verbose:
+        sys.stdout.write(f"\nChanges in {path}:\n")
+    log.write(f"\n--- {path} (old)\n+++ {path} (new)\n")
+    log.write(first)
+    if verbose:
+        sys.stdout.write(first)
+        for line in diff_lines:
+            log.write(line)
+            sys.stdout.write(line)
+        sys.stdout.write("\n")
+    else:
         log.writelines(diff_lines)
 
+def _external_diff(rel_path, old_path, new_path):
+    """Start `diff -u` on the two files; its stdout yields the diff lines, stderr is captured."""
+    return subprocess.Popen(
+        [DIFF_CMD, '-u',
+         '--label', f"{rel_path} (old)",
+         '--label', f"{rel_path} (new)",
+         old_path, new_path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, encoding='utf-8', errors='replace'
+    )
+
+def _walk(old_dir):
+    """Yield (rel_prefix, dirs, files) for each directory below old_dir, in os.walk order.
+
+    dirs and files hold DirEntry objects; rel_prefix is the directory's path
+    relative to old_dir with a trailing separator, or '' for old_dir itself.
+    Symlinked directories are reported but not descended into.
+    """
+    stack = [(old_dir, '')]
+    while stack:
+        top, prefix = stack.pop()
+        dirs = []
+        files = []
+        try:
+            with os.scandir(top) as it:
+                for entry in it:
+                    (dirs if entry.is_dir() else files).append(entry)
+        except OSError:
+            continue
+        yield prefix, dirs, files
+        for entry in reversed(dirs):
+            if not entry.is_symlink():
+                stack.append((entry.path, f"{prefix}{entry.name}{_SEP}"))
+
+def _list_dir(path):
+    """Map names to DirEntry objects for path; empty if it cannot be listed."""
+    try:
+        with os.scandir(path) as it:
+            return {entry.name: entry for entry in it}
+    except OSError:
+        return {}
+
+@dataclass
+class Entry:
+    """One path from the old tree and its counterpart in the new tree."""
+    __slots__ = ('rel_path', 'status', 'old_path', 'new_path', 'is_dir', 'src_st')
+    rel_path: str
+    status: str
+    old_path: str
+    new_path: str
+    is_dir: bool
+    src_st: os.stat_result
+
 def compare_dirs(old_dir, new_dir):
-    for root, dirs, files in os.walk(old_dir):
-        for entry in dirs + files:
-            old_path = os.path.join(root, entry)
-            rel_path = os.path.relpath(old_path, old_dir)
-            new_path = os.path.join(new_dir, rel_path)
-
-            if not os.path.exists(new_path):
-                yield rel_path, 'missing', old_path, new_path
-            else:
-                yield rel_path, 'exists', old_path, new_path
+    # One listing of the matching new directory answers every existence
+    # check for a directory's entries, and its paths share one prefix.
+    for prefix, dirs, files in _walk(old_dir):
+        new_top = os.path.join(new_dir, prefix)
+        new_entries = _list_dir(new_top)
+        new_top = os.path.join(new_top, '')
+        for is_dir, entries in ((True, dirs), (False, files)):
+            for entry in entries:
+                name = entry.name
+                new_path = new_top + name
+
+                new_entry = new_entries.get(name)
+                if new_entry is not None and new_entry.is_symlink():
+                    # A dangling link still counts as missing.
+                    exists = os.path.exists(new_path)
+                else:
+                    exists = new_entry is not None
+
+                try:
+                    src_st = entry.stat()
+                except FileNotFoundError:
+                    # A dangling symlink has no target metadata to sync or copy.
+                    print(f"Warning: Skipping dangling symlink {entry.path}.")
+                    continue
+
+                yield Entry(prefix + name, 'exists' if exists else 'missing', entry.path, new_path, is_dir, src_st)
 
 def select_items_with_curses(choices):
+    """Let the user pick from choices; returns the set of selected indices."""
     selected = set()
+    choices = tuple(choices)
 
     def menu(stdscr):
         curses.curs_set(0)
@@ -69,50 +371,76 @@ def select_items_with_curses(choices):
         top = 0
 
         all_selected = False
-        full_choices = ["[Select All]"] + choices
+        full_choices = ("[Select All]",) + choices
+
+        def draw_line(index, width):
+            if index == 0:
+                prefix = "[x]" if all_selected else "[ ]"
+            else:
+                prefix = "[x]" if index - 1 in selected else "[ ]"
+
+            choice = full_choices[index]
+            line = f"> {prefix} {choice}" if index == pos else f"  {prefix} {choice}"
+            try:
+                stdscr.move(index - top + 1, 0)
+                stdscr.clrtoeol()
+                stdscr.addstr(line[:width - 1], curses.A_REVERSE if index == pos else 0)
+            except curses.error:
+                pass
+
+        # Only repaint the lines a keystroke changed. Scrolling and "Select All"
+        # repaint every visible line, and curses still sends only the changed
+        # cells; the terminal is cleared and rewritten only on a resize.
+        clear_screen = True
+        repaint_all = False
+        dirty = ()
 
         while True:
-            stdscr.clear()
             height, width = stdscr.getmaxyx()
             max_visible = height - 2
-
-            stdscr.addstr(0, 0, "Select missing items to copy (SPACE to toggle, ENTER to confirm):")
-
-            visible_choices = full_choices[top:top + max_visible]
-
-            for i, choice in enumerate(visible_choices):
-                index = top + i
-                if index == 0:
-                    prefix = "[x]" if all_selected else "[ ]"
-                else:
-                    item = choices[index - 1]
-                    prefix = "[x]" if item in selected else "[ ]"
-
-                line = f"> {prefix} {choice}" if index == pos else f"  {prefix} {choice}"
-                try:
-                    stdscr.addstr(i + 1, 0, line[:width - 1], curses.A_REVERSE if index == pos else 0)
-                except curses.error:
-                    pass
+            visible = range(top, min(top + max_visible, len(full_choices)))
+
+            if clear_screen:
+                stdscr.clear()
+                stdscr.addstr(0, 0, "Select missing items to copy (SPACE to toggle, ENTER to confirm):")
+            if clear_screen or repaint_all:
+                dirty = visible
+            for index in dirty:
+                if index in visible:
+                    draw_line(index, width)
+            stdscr.noutrefresh()
+            curses.doupdate()
 
             key = stdscr.getch()
+            prev_pos = pos
+            prev_top = top
+            clear_screen = False
+            repaint_all = False
+            dirty = ()
 
             if key in [curses.KEY_UP, ord('k')]:
                 pos = (pos - 1) % len(full_choices)
+                dirty = (prev_pos, pos)
             elif key in [curses.KEY_DOWN, ord('j')]:
                 pos = (pos + 1) % len(full_choices)
+                dirty = (prev_pos, pos)
             elif key in [ord(' '), ord('\t')]:
                 if pos == 0:
                     all_selected = not all_selected
                     selected.clear()
                     if all_selected:
-                        selected.update(choices)
+                        selected.update(range(len(choices)))
+                    repaint_all = True
                 else:
-                    item = choices[pos - 1]
+                    item = pos - 1
                     if item in selected:
                         selected.remove(item)
                     else:
                         selected.add(item)
                     all_selected = len(selected) == len(choices)
+                    dirty = (0, pos)
+            elif key == curses.KEY_RESIZE:
+                clear_screen = True
             elif key in [curses.KEY_ENTER, ord('\n'), ord('\r')]:
                 break
 
@@ -120,15 +448,19 @@ def select_items_with_curses(choices):
                 top = pos
             elif pos >= top + max_visible:
                 top = pos - max_visible + 1
+            if top != prev_top:
+                repaint_all = True
 
     curses.wrapper(menu)
-    return list(selected)
+    return selected
 
 def main():
     parser = argparse.ArgumentParser(description='Compare and sync user-specific files and directories between Tomcat installations.')
     parser.add_argument('old_dir', help='Path to original/old Tomcat installation')
     parser.add_argument('new_dir', help='Path to new/destination Tomcat installation')
     parser.add_argument('--verbose', '-v', action='store_true', help='Enable verbose output')
+    parser.add_argument('--deep', action='store_true',
+                        help='Compare file contents even when size and modification time match')
 
     args = parser.parse_args()
     verbose = args.verbose
@@ -144,37 +476,57 @@ def main():
     updated = 0
     missing_items = []
 
-    for rel_path, status, old_path, new_path in compare_dirs(args.old_dir, args.new_dir):
-        is_dir = os.path.isdir(old_path)
-        if status == 'missing':
-            missing_items.append((rel_path, old_path, new_path, is_dir))
-        else:
-            update_metadata(old_path, new_path, verbose=verbose)
-            updated += 1
-
-            if not is_dir and (rel_path.startswith("conf" + os.sep) or os.sep + "conf" + os.sep in old_path):
-                old_lines = read_file_lines(old_path)
-                new_lines = read_file_lines(new_path)
-                diff = list(difflib.unified_diff(
-                    old_lines, new_lines,
-                    fromfile=f"{rel_path} (old)",
-                    tofile=f"{rel_path} (new)",
-                    lineterm=''
-                ))
-                if diff:
-                    if verbose:
-                        print(f"\nChanges in {rel_path}:\n" + "".join(diff))
-                    log_diff(rel_path, diff)
+    conf_checks = []
+
+    with ThreadPoolExecutor(max_workers=COMPARE_WORKERS) as pool:
+        for item in compare_dirs(args.old_dir, args.new_dir):
+            if item.status == 'missing':
+                missing_items.append(item)
+            else:
+                update_metadata(item.new_path, item.src_st, verbose=verbose)
+                updated += 1
+
+                if not item.is_dir and _CONF_RE.search(item.rel_path) is not None:
+                    conf_checks.append((item, pool.submit(_compare_conf, item, not args.deep)))
+
+        # Drained in walk order so the log stays deterministic.
+        for item, same in conf_checks:
+            rel_path = item.rel_path
+            try:
+                equal, new_size = same.result()
+                if equal:
+                    continue
+            except OSError as e:
+                print(f"Warning: Cannot compare {rel_path}, skipping diff: {e}")
+                continue
+            if DIFF_CMD and min(item.src_st.st_size, new_size) >= EXTERNAL_DIFF_MIN_SIZE:
+                with _external_diff(rel_path, item.old_path, item.new_path) as proc:
+                    log_diff(rel_path, proc.stdout, verbose=verbose)
+                    errors = proc.stderr.read().strip()
+                # diff exits 0 for no differences, 1 for differences, 2 for trouble.
+                if proc.returncode > 1:
+                    print(f"Warning: diff failed for {rel_path} (exit {proc.returncode}); "
+                          f"its log entry may be incomplete: {errors}")
+                continue
+            old_lines = read_file_lines(item.old_path)
+            new_lines = read_file_lines(item.new_path)
+            diff = difflib.unified_diff(
+                old_lines, new_lines,
+                fromfile=f"{rel_path} (old)",
+                tofile=f"{rel_path} (new)",
+                lineterm=''
+            )
+            log_diff(rel_path, diff, verbose=verbose)
 
     if missing_items:
         print("\nMissing items detected.")
-        choices = [f[0] for f in missing_items]
+        choices = [item.rel_path for item in missing_items]
         selected = select_items_with_curses(choices)
 
-        for rel_path, old_path, new_path, is_dir in missing_items:
-            if rel_path in selected:
-                os.makedirs(os.path.dirname(new_path), exist_ok=True)
-                copy_with_metadata(old_path, new_path, is_dir=is_dir, verbose=verbose)
+        for index, item in enumerate(missing_items):
+            if index in selected:
+                _ensure_dir(os.path.dirname(item.new_path))
+                copy_with_metadata(item.old_path, item.new_path, item.src_st, is_dir=item.is_dir, verbose=verbose)
                 copied += 1
 
     print(f"\nSummary:")